@@ -1,30 +1,49 @@
 import os
+import hashlib
 import sys
 import uuid
+import queue
 import time
 import logging
 import tempfile
+import threading
 import traceback
-from flask import Flask, request, jsonify, g
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
-from asgiref.wsgi import WsgiToAsgi
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
 from chord_extractor.extractors import Chordino
 import librosa
 import numpy as np
+import orjson
+import soundfile as sf
 import scipy.io.wavfile as wavfile
 import sqlite3
+import struct
 import json
-from stem_separator import StemSeparator
+from stem_separator import StemSeparator, STEM_NAMES
 
 # -----------------------------
 # Database Setup
 # -----------------------------
 DB_NAME = "cognify.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+# Reused connections; see get_conn()
+_pool = queue.Queue()
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, timeout=30)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')
+    return conn
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = _connect()
+    # WAL is persistent in the db file and lets readers run alongside a writer
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS songs (
@@ -35,8 +54,69 @@ def init_db():
             analysis_json TEXT
         )
     ''')
+    # Superseded by analysis_cache, which tracks size and last use for eviction
+    c.execute('DROP TABLE IF EXISTS results_cache')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            key TEXT PRIMARY KEY,
+            body BLOB,
+            size INTEGER,
+            used_at REAL
+        )
+    ''')
+    # Entries from older analysis versions can never be hit again
+    c.execute('DELETE FROM analysis_cache WHERE key NOT LIKE ?', (f"v{ANALYSIS_CACHE_VERSION}:%",))
     conn.commit()
-    conn.close()
+
+    _pool.put(conn)
+    for _ in range(DB_POOL_SIZE - 1):
+        _pool.put(_connect())
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection; rolls back uncommitted work on error."""
+    conn = _pool.get()
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        _pool.put(conn)
+
+# Bump when the analysis output changes so stale cache entries are never served
+ANALYSIS_CACHE_VERSION = "2"
+# Least recently used analyses are evicted once the cache holds more than this
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+def cache_key(digest, separator):
+    # The separator settings decide which stems get analysed
+    return f"v{ANALYSIS_CACHE_VERSION}:{separator.settings_key}:{digest}"
+
+def get_cached_result(key):
+    """Return the cached analysis dict for `key`, or None."""
+    with get_conn() as conn:
+        row = conn.execute('SELECT body FROM analysis_cache WHERE key = ?', (key,)).fetchone()
+        if row:
+            conn.execute('UPDATE analysis_cache SET used_at = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+    return orjson.loads(row[0]) if row else None
+
+def store_cached_result(key, payload):
+    """Store serialized analysis JSON (bytes) under `key`, then evict past RESULT_CACHE_MAX_BYTES."""
+    # Kept as bytes (stored as a BLOB) to avoid a decoded copy; orjson.loads takes either
+    with get_conn() as conn:
+        conn.execute('INSERT OR REPLACE INTO analysis_cache (key, body, size, used_at) VALUES (?, ?, ?, ?)',
+                     (key, payload, len(payload), time.time()))
+        # Keep the most recently used entries whose running total fits the budget
+        conn.execute('''
+            DELETE FROM analysis_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY used_at DESC) AS total FROM analysis_cache
+                ) WHERE total > ?
+            )
+        ''', (RESULT_CACHE_MAX_BYTES,))
+        conn.commit()
 
 # Initialize DB on start
 init_db()
@@ -64,13 +144,62 @@ logger.addHandler(handler)
 # Flask app
 # -----------------------------
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'backend', 'uploads')
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "200")) * 1024 * 1024
 CORS(app, resources={r"/*": {"origins": "*"}}, methods=["GET", "POST", "DELETE", "OPTIONS"])
-asgi_app = WsgiToAsgi(app)
+
+# -----------------------------
+# Shared extractors
+# -----------------------------
+# Chordino loads the Vamp plugin on construction, so build it once per process
+_chordino = None
+_chordino_lock = threading.Lock()
+
+# Chordino and pyin both spend their time in native code, so they overlap well in threads
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2"))
+analysis_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="analysis")
+
+# One StemSeparator per output folder. STEM_MAX_BATCH > 1 lets concurrent uploads
+# share a Demucs batch; off by default since every call would wait out the batch window
+STEM_MAX_BATCH = int(os.getenv("STEM_MAX_BATCH", "1"))
+STEM_QUALITY = os.getenv("STEM_QUALITY", "fast")
+STEM_COMPILE = os.getenv("STEM_COMPILE") == "1"
+# "wav" or "flac"; /api/mix reads either
+STEM_FORMAT = os.getenv("STEM_FORMAT", "wav")
+# Run demucs in a separate long-lived worker process instead of inside the web workers
+STEM_ISOLATE = os.getenv("STEM_ISOLATE") == "1"
+_separators = {}
+_separators_lock = threading.Lock()
+
+def get_chordino():
+    global _chordino
+    if _chordino is None:
+        with _chordino_lock:
+            if _chordino is None:
+                _chordino = Chordino()
+    return _chordino
+
+def get_separator(output_dir):
+    separator = _separators.get(output_dir)
+    if separator is None:
+        with _separators_lock:
+            separator = _separators.get(output_dir)
+            if separator is None:
+                try:
+                    separator = StemSeparator(output_dir, max_batch=STEM_MAX_BATCH, quality_mode=STEM_QUALITY,
+                                              compile_model=STEM_COMPILE, stem_format=STEM_FORMAT,
+                                              in_process=not STEM_ISOLATE,
+                                              persistent_worker=STEM_ISOLATE)
+                except Exception as e:
+                    # e.g. model weights can't be loaded/downloaded; don't retry on every request
+                    log_exception("Stem separator setup failed, using the demucs subprocess", e)
+                    separator = StemSeparator(output_dir, in_process=False, quality_mode=STEM_QUALITY,
+                                              stem_format=STEM_FORMAT)
+                _separators[output_dir] = separator
+    return separator
 
 # -----------------------------
 # Helpers
@@ -85,75 +214,248 @@ def to_float(val):
 def freq_to_note_name(freq):
     return librosa.hz_to_note(freq)
 
-def get_chord_notes(chord_name):
-    # Simple dictionary for common chords - expand as needed or use a library
-    # Logic: simplistic mapping for demo purposes
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+NOTE_TO_PC = {name: pc for pc, name in enumerate(NOTE_NAMES)}
+
+# Major scale intervals: 2, 2, 1, 2, 2, 2, 1
+MAJOR_SCALE_INTERVALS = [0, 2, 4, 5, 7, 9, 11]
+
+# Role codes produced by classify_pitch_classes, mapped to labels on output
+ROLE_NAMES = ["Passing Note", "Scale Note", "Chord Tone"]
+
+def intervals_mask(root_pc, intervals):
+    """12-bit mask with one bit set per pitch class of root + intervals."""
+    mask = 0
+    for interval in intervals:
+        mask |= 1 << ((root_pc + interval) % 12)
+    return mask
+
+def chord_mask(chord_name):
+    """Bitmask of chord-tone pitch classes; 0 for "N"/unknown chords."""
+    # Simple triad mapping for demo purposes
     # Ideally use a library like mingus or music21 if available, but let's keep it light
+    if not chord_name:
+        return 0
     root = chord_name[0]
     if len(chord_name) > 1 and chord_name[1] == '#':
         root = chord_name[:2]
-    
-    # Basic Intervals relative to root
-    # Major: 0, 4, 7
-    # Minor: 0, 3, 7
-    # 7: 0, 4, 7, 10
-    # Maj7: 0, 4, 7, 11
-    # m7: 0, 3, 7, 10
-    
-    notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-    try:
-        root_idx = notes.index(root)
-    except ValueError:
-        return []
+
+    root_pc = NOTE_TO_PC.get(root)
+    if root_pc is None:
+        return 0
 
     intervals = [0, 4, 7] # Default Major
     if 'm' in chord_name and 'maj' not in chord_name:
         intervals = [0, 3, 7]
-    
-    chord_notes = []
-    for interval in intervals:
-        note = notes[(root_idx + interval) % 12]
-        chord_notes.append(note)
-    
-    return set(chord_notes)
+    return intervals_mask(root_pc, intervals)
 
-def is_scale_note(note_name, key):
-    # Simplified scale check (Major scale of the key)
-    # Key should be e.g. "C", "G#"
-    if not key:
-        return True # Default to true if no key detected
-    
-    notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-    
-    # Major scale intervals: 2, 2, 1, 2, 2, 2, 1
-    major_scale_intervals = [0, 2, 4, 5, 7, 9, 11]
-    
+def scale_mask(key):
+    """Bitmask of the major scale of `key`; all notes if the key is unknown."""
+    root_pc = NOTE_TO_PC.get(key) if key else None
+    if root_pc is None:
+        return 0xFFF # Default to every note in scale if no key detected
+    return intervals_mask(root_pc, MAJOR_SCALE_INTERVALS)
+
+def bar_beat_positions(event_times):
+    """
+    Bar/beat numbers for sorted chord event times. A gap of 2s or more from the
+    previous event (or from 0 for the first) starts a new bar at beat 1;
+    otherwise the beat counter advances from its initial bar 1, beat 1.
+    """
+    new_bar = np.diff(event_times, prepend=0.0) >= 2
+    bars = 1 + np.cumsum(new_bar)
+
+    # Position of the most recent bar start at or before each event (-1 = none yet)
+    positions = np.arange(len(event_times))
+    last_start = np.maximum.accumulate(np.where(new_bar, positions, -1))
+    beats = np.where(last_start >= 0, positions - last_start + 1, positions + 2)
+    return bars, beats
+
+def hz_to_pitch_class(freqs):
+    """Vectorized Hz -> pitch class (C=0 ... B=11), rounding like librosa.hz_to_note."""
+    midi = np.round(12 * np.log2(np.asarray(freqs, dtype=np.float64) / 440.0)).astype(np.int64)
+    return (midi + 9) % 12
+
+def classify_pitch_classes(pitch_classes, chord_masks, key_mask):
+    """
+    Role code per frame: 2 = chord tone, 1 = scale note, 0 = passing note.
+    `chord_masks` holds the active chord's bitmask for each frame.
+    """
+    chord_masks = np.asarray(chord_masks, dtype=np.int64)
+    is_chord = (chord_masks >> pitch_classes) & 1
+    is_scale = (key_mask >> pitch_classes) & 1
+    return np.where(is_chord, 2, is_scale)
+
+# Analysis rate for pyin/chroma (librosa's default)
+MELODY_SR = 22050
+
+def load_mono(path, target_sr):
+    """
+    Decode audio with libsndfile, downmix to mono and resample to target_sr.
+    Falls back to librosa.load (audioread) for formats libsndfile can't read.
+    """
     try:
-        root_idx = notes.index(key)
-    except ValueError:
-        return True
-        
-    scale_notes = set()
-    for interval in major_scale_intervals:
-        scale_notes.add(notes[(root_idx + interval) % 12])
-        
-    # note_name comes as "C#4", we need "C#"
-    pitch_class = ''.join([c for c in note_name if not c.isdigit()])
-    return pitch_class in scale_notes
+        y, sr = sf.read(path, dtype='float32', always_2d=False)
+    except RuntimeError:
+        return librosa.load(path, sr=target_sr)
+
+    if y.ndim == 2:
+        y = y.mean(axis=1)
+    if sr != target_sr:
+        y = librosa.resample(y, orig_sr=sr, target_sr=target_sr, res_type='soxr_hq')
+        sr = target_sr
+    return y, sr
+
+def extract_melody(path):
+    """
+    Run pyin and global key detection on `path`.
+    Returns (f0, voiced_flag, frame_times, key_name).
+    """
+    y, sr = load_mono(path, MELODY_SR)
 
-def classify_note(note_name, chord_name, key):
-    if not note_name or not chord_name:
-        return "Passing Note"
-    
-    pitch_class = ''.join([c for c in note_name if not c.isdigit()])
-    chord_notes = get_chord_notes(chord_name)
-    
-    if pitch_class in chord_notes:
-        return "Chord Tone"
-    elif is_scale_note(note_name, key):
-        return "Scale Note"
-    else:
-        return "Passing Note"
+    # Extract f0 using pyin (standard for melody)
+    f0, voiced_flag, voiced_probs = librosa.pyin(y, sr=sr, fmin=librosa.note_to_hz('C2'), fmax=librosa.note_to_hz('C7'))
+    times = librosa.times_like(f0, sr=sr)
+
+    # Detect Key (Global): only the argmax of the summed chroma is used, so the
+    # STFT-based chroma is enough here (chroma_cens if accuracy ever matters more)
+    chroma = librosa.feature.chroma_stft(y=y, sr=sr, n_fft=4096, hop_length=2048)
+    key_index = int(np.argmax(chroma.sum(axis=1)))
+    return f0, voiced_flag, times, NOTE_NAMES[key_index]
+
+UPLOAD_COPY_BUFSIZE = 1024 * 1024
+
+def save_upload(file, dest_path):
+    """
+    Write an uploaded FileStorage to dest_path with a 1 MiB copy buffer,
+    hashing the bytes on the way. Returns the BLAKE2b hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    stream = file.stream
+    with open(dest_path, 'wb') as out:
+        while True:
+            chunk = stream.read(UPLOAD_COPY_BUFSIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+def wav_nframes(path):
+    """Frame count of a WAV file, read from its chunk headers only."""
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f"Not a RIFF/WAVE file: {path}")
+
+        block_align = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f"No data chunk in {path}")
+            chunk_id = header[:4]
+            size = struct.unpack('<I', header[4:])[0]
+
+            if chunk_id == b'fmt ':
+                fmt = f.read(size)
+                # audio format, channels, sample rate, byte rate, then block align
+                block_align = struct.unpack('<H', fmt[12:14])[0]
+                f.seek(size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if not block_align:
+                    raise ValueError(f"data chunk before fmt chunk in {path}")
+                return size // block_align
+            else:
+                # Chunks are word aligned
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+# Full-scale factors to float for the sample formats demucs/scipy produce
+PCM_SCALE = {
+    np.dtype('int16'): np.float32(1.0 / 32768.0),
+    np.dtype('int32'): np.float32(1.0 / 2147483648.0),
+    np.dtype('float32'): np.float32(1.0),
+    np.dtype('float64'): np.float32(1.0),
+}
+
+def stem_nframes(path):
+    """Frame count of a stem file from its header."""
+    if path.endswith('.wav'):
+        return wav_nframes(path)
+    return sf.info(path).frames
+
+def read_stem(path, nframes):
+    """(sample rate, first nframes samples) of a stem; WAVs are memory-mapped."""
+    if path.endswith('.wav'):
+        sr, data = wavfile.read(path, mmap=True)
+        return sr, data[:nframes]
+    data, sr = sf.read(path, frames=nframes, dtype='float32', always_2d=True)
+    return sr, data
+
+def mix_stems(paths):
+    """
+    Sum stems (WAV or any format libsndfile decodes) into one 16-bit PCM track,
+    truncated to the shortest stem.
+    Returns (sample_rate, int16 array), or (None, None) if no stem exists.
+    """
+    paths = [p for p in paths if os.path.exists(p)]
+    if not paths:
+        return None, None
+
+    # Handle length mismatch (rare if same demucs run) from the headers alone
+    min_len = min(stem_nframes(p) for p in paths)
+
+    # Accumulate in place: one float32 output buffer plus one reusable scratch buffer
+    out = scaled = None
+    sample_rate = 44100
+    for p in paths:
+        # WAVs are memory-mapped: pages are read lazily while summing, never copied whole
+        sr, data = read_stem(p, min_len)
+        sample_rate = sr
+        if out is None:
+            out = np.zeros((min_len,) + data.shape[1:], dtype=np.float32)
+            scaled = np.empty_like(out)
+        scale = PCM_SCALE.get(data.dtype)
+        if scale is None:
+            scale = np.float32(1.0 / np.iinfo(data.dtype).max if np.issubdtype(data.dtype, np.integer) else 1.0)
+        np.multiply(data, scale, out=scaled, dtype=np.float32, casting='unsafe')
+        np.add(out, scaled, out=out)
+        del data
+
+    # Clip and convert back to 16-bit PCM for compatibility
+    np.clip(out, -1.0, 1.0, out=out)
+    out16 = np.empty(out.shape, dtype=np.int16)
+    np.multiply(out, np.float32(32767), out=out16, casting='unsafe')
+    return sample_rate, out16
+
+def separate_upload(path, digest):
+    """
+    Separate an upload into stems; digest is its save_upload() hash.
+    Returns (stems, stem_urls); both are empty if separation failed.
+    """
+    stems = {}
+    stem_urls = {}
+    try:
+        separator = get_separator(app.config['UPLOAD_FOLDER'])
+        # This might take time
+        # We need all four stems: 'other' feeds Chordino, 'vocals' feeds pyin, and
+        # the player / instrumental mix use drums, bass and other
+        stems = separator.separate(path, stems_wanted=STEM_NAMES, digest=digest)
+
+        # Generate URLs for stems
+        # Path relative to UPLOAD_FOLDER
+        for name, stem_path in stems.items():
+            # path is e.g. .../uploads/htdemucs/song/vocals.wav
+            # Our serve_audio route handles /uploads/<path:filename>
+            # So we need relative path from UPLOAD_FOLDER
+            rel_path = os.path.relpath(stem_path, app.config['UPLOAD_FOLDER'])
+            # Ensure forward slashes for URL
+            rel_path = rel_path.replace('\\', '/')
+            stem_urls[name] = f"http://localhost:5000/uploads/{rel_path}"
+    except Exception as e:
+        logger.error(f"Stem separation skipped/failed: {e}")
+        # Fallback to original
+        return {}, {}
+    return stems, stem_urls
 
 def log_exception(msg, exc):
     logger.error(f"{msg}: {exc}")
@@ -207,7 +509,7 @@ def analyze_chords():
         # Create unique filename to avoid collisions
         unique_filename = f"{uuid.uuid4().hex}_{safe_name}"
         save_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(save_path)
+        content_hash = save_upload(file, save_path)
         
         # Audio URL for frontend
         audio_url = f"http://localhost:5000/uploads/{unique_filename}"
@@ -216,6 +518,25 @@ def analyze_chords():
     except Exception as e:
         log_exception("Failed to save file", e)
         return jsonify({'error': 'Failed to save uploaded file'}), 500
+
+    # -------------------------
+    # Result cache (same bytes → same analysis)
+    # -------------------------
+    result_key = None
+    try:
+        result_key = cache_key(content_hash, get_separator(app.config['UPLOAD_FOLDER']))
+        cached = get_cached_result(result_key)
+    except Exception as e:
+        log_exception("Result cache lookup failed", e)
+        cached = None
+    if cached is not None:
+        logger.info(f"Result cache hit for {content_hash}")
+        # The stem cache links the stems into this upload's own folder, which
+        # /api/mix looks up by upload name
+        _, stem_urls = separate_upload(save_path, content_hash)
+        cached["audioUrl"] = audio_url
+        cached["stems"] = stem_urls
+        return Response(orjson.dumps(cached), status=200, mimetype='application/json')
         
     # Use the saved path for analysis
     temp_path = save_path
@@ -223,44 +544,18 @@ def analyze_chords():
     # -------------------------
     # Stem Separation
     # -------------------------
-    stems = {}
-    stem_urls = {}
-    separator = StemSeparator(app.config['UPLOAD_FOLDER'])
-    
+    logger.info("Step 1.5: Running Stem Separation")
+    stems, stem_urls = separate_upload(temp_path, content_hash)
+    # Only results computed from real stems are cached; a fallback to the
+    # original mix must not be served for every later upload of these bytes
+    separation_ok = bool(stems)
+
     # Default sources for analysis
-    chord_source = temp_path
-    melody_source = temp_path
-    
-    try:
-        logger.info("Step 1.5: Running Stem Separation")
-        # This might take time
-        # We only run if not already separated (rudimentary check could be added)
-        stems = separator.separate(temp_path)
-        
-        if 'other' in stems:
-            chord_source = stems['other']
-        if 'vocals' in stems:
-            melody_source = stems['vocals']
-            
-        # Generate URLs for stems
-        # Path relative to UPLOAD_FOLDER
-        for name, path in stems.items():
-            # path is e.g. .../uploads/htdemucs/song/vocals.wav
-            # We need valid URL. 
-            # Our serve_audio route handles /uploads/<path:filename>
-            # So we need relative path from UPLOAD_FOLDER
-            rel_path = os.path.relpath(path, app.config['UPLOAD_FOLDER'])
-            # Ensure forward slashes for URL
-            rel_path = rel_path.replace('\\', '/')
-            stem_urls[name] = f"http://localhost:5000/uploads/{rel_path}"
-            
+    chord_source = stems.get('other', temp_path)
+    melody_source = stems.get('vocals', temp_path)
+    if separation_ok:
         logger.info(f"Separation complete. Chords from {os.path.basename(chord_source)}, Melody from {os.path.basename(melody_source)}")
 
-    except Exception as e:
-        logger.error(f"Stem separation skipped/failed: {e}")
-        # Fallback to original
-        pass
-
     # -------------------------
     # Chord extraction
     # -------------------------
@@ -270,122 +565,95 @@ def analyze_chords():
     stats = {"total_events": 0, "skipped": 0, "no_chord": 0, "processed": 0}
 
     try:
-        logger.info("Step 2: Running Chordino.extract()")
-        chordino = Chordino()
-        # Use separated source if available
-        chords_with_timestamps = chordino.extract(chord_source)
+        # Chords and melody read different stems and don't depend on each other
+        # until classification, so run them side by side
+        logger.info("Step 2: Running Chordino.extract() and melody extraction")
+        chordino = get_chordino()
+        # Use separated sources if available
+        chords_future = analysis_executor.submit(chordino.extract, chord_source)
+        melody_future = analysis_executor.submit(extract_melody, melody_source)
+
+        chords_with_timestamps = chords_future.result()
         logger.info(f"Chordino produced {len(chords_with_timestamps)} raw events")
 
-        # 🔹 Debug print before processing (raw chords)
-        print("\n=== Raw chords_with_timestamps (first 10) ===")
-        for idx, item in enumerate(chords_with_timestamps[:10]):
-            print(f"{idx}: {item}")
-        print("============================================\n")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw chords_with_timestamps (first 10): %s", chords_with_timestamps[:10])
 
         # -------------------------
         # Process events
         # -------------------------
         logger.info("Step 3: Processing chord events")
-        bar, beat, prev_time = 1, 1, 0.0
-
-        for idx, item in enumerate(chords_with_timestamps):
-            stats["total_events"] += 1
-
-            # ✅ Handle ChordChange objects
-            try:
-                time_raw = getattr(item, "timestamp", None)
-                chord = getattr(item, "chord", None)
-            except Exception:
-                stats["skipped"] += 1
-                continue
-
-            time_val = to_float(time_raw)
+        # ✅ Handle ChordChange objects; drop events without a usable time/chord
+        events = []
+        for item in chords_with_timestamps:
+            time_val = to_float(getattr(item, "timestamp", None))
+            chord = getattr(item, "chord", None)
             if time_val is None or chord is None:
-                stats["skipped"] += 1
                 continue
-
-            # Bar/beat detection
-            if time_val - prev_time >= 2:
-                bar += 1
-                beat = 1
-            else:
-                beat += 1
-            prev_time = time_val
-            last_valid_time = time_val
-
-            # Normalize chord
-            if chord == "N":
-                chord_out = "No Chord"
-                stats["no_chord"] += 1
-            else:
-                chord_out = chord
-
-            chords.append({
-                "time": time_val,
-                "chord": chord_out,
-                "confidence": 1.0,
-                "beat": beat,
-                "bar": bar
-            })
-            stats["processed"] += 1
+            events.append((time_val, chord))
+
+        stats["total_events"] = len(chords_with_timestamps)
+        stats["processed"] = len(events)
+        stats["skipped"] = stats["total_events"] - stats["processed"]
+        stats["no_chord"] = sum(1 for _, chord in events if chord == "N")
+
+        event_times = np.array([time_val for time_val, _ in events], dtype=np.float64)
+        bars, beats = bar_beat_positions(event_times)
+
+        # Normalize chord
+        chords = [{
+            "time": time_val,
+            "chord": "No Chord" if chord == "N" else chord,
+            "confidence": 1.0,
+            "beat": beat,
+            "bar": bar
+        } for (time_val, chord), bar, beat in zip(events, bars.tolist(), beats.tolist())]
+        last_valid_time = events[-1][0] if events else None
 
         duration = float(last_valid_time) if last_valid_time else 0.0
         logger.info(f"Processing complete → {len(chords)} usable events")
 
-        # 🔹 Debug print processed chords
-        print("\n=== Processed chords (first 10) ===")
-        for idx, c in enumerate(chords[:10]):
-            print(f"{idx}: {c}")
-        print("===================================\n")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Processed chords (first 10): %s", chords[:10])
 
         # -------------------------
         # Melody Extraction (librosa)
         # -------------------------
-        logger.info("Step 4: Extracting Melody")
-        # Use separated source if available
-        y, sr = librosa.load(melody_source)
-        
-        # Extract f0 using pyin (standard for melody)
-        f0, voiced_flag, voiced_probs = librosa.pyin(y, fmin=librosa.note_to_hz('C2'), fmax=librosa.note_to_hz('C7'))
-        times = librosa.times_like(f0)
-        
-        # Detect Key (Global)
-        chroma = librosa.feature.chroma_cqt(y=y, sr=sr)
-        key_index = np.argmax(np.sum(chroma, axis=1))
-        notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        detected_key = notes[key_index]
+        logger.info("Step 4: Waiting for melody extraction")
+        f0, voiced_flag, times, detected_key = melody_future.result()
         logger.info(f"Detected Key: {detected_key}")
 
+        # Current chord for every frame in one pass: index of the last chord
+        # starting at or before each frame time (-1 = before the first chord)
+        chord_times = np.asarray([c['time'] for c in chords], dtype=np.float64)
+        chord_idx = np.searchsorted(chord_times, times, side='right') - 1
+
+        # One bitmask per chord event, plus a trailing 0 so index -1 means "no chord"
+        label_masks = {}
+        for c in chords:
+            if c['chord'] not in label_masks:
+                label_masks[c['chord']] = chord_mask(c['chord'])
+        chord_masks = np.array([label_masks[c['chord']] for c in chords] + [0], dtype=np.uint16)
+
         # Process Melody Notes
-        # We sample points where f0 is voiced
-        for i, val in enumerate(f0):
-            if not np.isnan(val) and voiced_flag[i]:
-                t = times[i]
-                note = librosa.hz_to_note(val)
-                
-                # Find current chord
-                current_chord = "N"
-                # Simple linear search or improve with bisect if needed, but array is small
-                for c in chords:
-                    if c['time'] <= t:
-                        current_chord = c['chord']
-                    else:
-                        break
-                
-                role = classify_note(note, current_chord, detected_key)
-                
-                # Reduce density: only take points every ~0.1s or so, or just dump all?
-                # For UI performance, let's take all but frontend might need downsampling
-                # Actually, let's just create events when note changes or significant time passes?
-                # For now, simplistic raw dump, let frontend handle or decimate here.
-                # Let's decimate to every 5th frame to reduce JSON size
-                if i % 5 == 0: 
-                    melody_events.append({
-                        "time": float(t),
-                        "pitch": float(val),
-                        "note": note,
-                        "role": role
-                    })
+        # We sample voiced frames only, decimated to every 5th to reduce JSON size
+        voiced_idx = np.flatnonzero(voiced_flag & ~np.isnan(f0))[::5]
+        sel_times = times[voiced_idx]
+        sel_f0 = f0[voiced_idx]
+        pitch_classes = hz_to_pitch_class(sel_f0)
+        role_codes = classify_pitch_classes(pitch_classes, chord_masks[chord_idx[voiced_idx]],
+                                            scale_mask(detected_key))
+
+        # One vectorized call for all note names (same spelling as the per-frame call)
+        note_names = np.asarray(librosa.hz_to_note(sel_f0)).tolist() if len(sel_f0) else []
+
+        for t, val, note, role_code in zip(sel_times, sel_f0, note_names, role_codes):
+            melody_events.append({
+                "time": t,
+                "pitch": val,
+                "note": note,
+                "role": ROLE_NAMES[role_code]
+            })
 
     except Exception as e:
         log_exception("Chord extraction failed", e)
@@ -404,14 +672,19 @@ def analyze_chords():
         "timeSignature": "4/4",   # placeholder
         "melody": melody_events,
         "chords": chords,
-        "chords": chords,
-        "melody": melody_events,
-        "chords": chords,
         "audioUrl": audio_url,
         "stems": stem_urls,
         "debug": {"stats": stats}
     }
-    return jsonify(result), 200
+    # Serialized once; the same bytes are cached and sent. orjson handles the
+    # NumPy scalars in melody events directly
+    body = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY)
+    if separation_ok and result_key is not None:
+        try:
+            store_cached_result(result_key, body)
+        except Exception as e:
+            log_exception("Result cache store failed", e)
+    return Response(body, status=200, mimetype='application/json')
 
 @app.route('/uploads/<path:filename>')
 def serve_audio(filename):
@@ -435,12 +708,11 @@ def save_song():
         return jsonify({'error': 'No analysis data'}), 400
 
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('INSERT INTO songs (id, title, artist, created_at, analysis_json) VALUES (?, ?, ?, ?, ?)',
-                  (song_id, title, artist, time.time(), json.dumps(analysis)))
-        conn.commit()
-        conn.close()
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute('INSERT INTO songs (id, title, artist, created_at, analysis_json) VALUES (?, ?, ?, ?, ?)',
+                      (song_id, title, artist, time.time(), json.dumps(analysis)))
+            conn.commit()
         return jsonify({'id': song_id, 'message': 'Saved successfully'}), 200
     except Exception as e:
         log_exception("Save failed", e)
@@ -449,11 +721,10 @@ def save_song():
 @app.route('/api/songs', methods=['GET'])
 def list_songs():
     try:
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        c.execute('SELECT id, title, artist, created_at FROM songs ORDER BY created_at DESC')
-        rows = c.fetchall()
-        conn.close()
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, title, artist, created_at FROM songs ORDER BY created_at DESC')
+            rows = c.fetchall()
         
         songs = [{'id': r[0], 'title': r[1], 'artist': r[2], 'createdAt': r[3]} for r in rows]
         return jsonify(songs), 200
@@ -465,11 +736,10 @@ def list_songs():
 def handle_song(song_id):
     if request.method == 'GET':
         try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('SELECT analysis_json FROM songs WHERE id = ?', (song_id,))
-            row = c.fetchone()
-            conn.close()
+            with get_conn() as conn:
+                c = conn.cursor()
+                c.execute('SELECT analysis_json FROM songs WHERE id = ?', (song_id,))
+                row = c.fetchone()
             
             if row:
                 return jsonify(json.loads(row[0])), 200
@@ -481,31 +751,25 @@ def handle_song(song_id):
 
     elif request.method == 'DELETE':
         try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            
-            c.execute('SELECT analysis_json FROM songs WHERE id = ?', (song_id,))
-            row = c.fetchone()
-            
+            # Single round trip (SQLite >= 3.35): delete and get the row back
+            with get_conn() as conn:
+                row = conn.execute('DELETE FROM songs WHERE id = ? RETURNING analysis_json',
+                                   (song_id,)).fetchone()
+                conn.commit()
+
             if row:
                 data = json.loads(row[0])
                 audio_url = data.get('audioUrl')
                 if audio_url:
                     filename = audio_url.split('/')[-1]
                     file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    if os.path.exists(file_path):
-                        try:
-                            os.remove(file_path)
-                            logger.info(f"Deleted file: {file_path}")
-                        except Exception as e:
-                            logger.warning(f"Failed to delete file {file_path}: {e}")
-
-                        except Exception as e:
-                            logger.warning(f"Failed to delete file {file_path}: {e}")
-
-            c.execute('DELETE FROM songs WHERE id = ?', (song_id,))
-            conn.commit()
-            conn.close()
+                    try:
+                        os.remove(file_path)
+                        logger.info(f"Deleted file: {file_path}")
+                    except FileNotFoundError:
+                        pass
+                    except Exception as e:
+                        logger.warning(f"Failed to delete file {file_path}: {e}")
             
             return jsonify({'message': 'Song deleted'}), 200
         except Exception as e:
@@ -548,39 +812,20 @@ def download_mix(filename, mix_type):
         if not os.path.exists(target_dir):
              return jsonify({'error': 'Stems not found'}), 404
 
+        stem_ext = get_separator(app.config['UPLOAD_FOLDER']).stem_ext
+
         if mix_type == 'vocals':
-            return send_from_directory(target_dir, 'vocals.wav', as_attachment=True)
+            return send_from_directory(target_dir, 'vocals' + stem_ext, as_attachment=True)
             
         elif mix_type == 'instrumental':
             # Check if pre-mixed exists
             mix_path = os.path.join(target_dir, 'instrumental.wav')
             if not os.path.exists(mix_path):
                 # Mix on the fly
-                # Load stems
-                stems = ['drums.wav', 'bass.wav', 'other.wav']
-                mixed_audio = None
-                sample_rate = 44100
-                
-                for stem in stems:
-                    p = os.path.join(target_dir, stem)
-                    if os.path.exists(p):
-                        sr, data = wavfile.read(p)
-                        sample_rate = sr
-                        # Ensure float for mixing
-                        if data.dtype != np.float32:
-                             data = data.astype(np.float32) / (np.iinfo(data.dtype).max if np.issubdtype(data.dtype, np.integer) else 1.0)
-                        
-                        if mixed_audio is None:
-                            mixed_audio = data
-                        else:
-                            # Handle length mismatch (rare if same demucs run)
-                            min_len = min(len(mixed_audio), len(data))
-                            mixed_audio = mixed_audio[:min_len] + data[:min_len]
-                
+                stems = [name + stem_ext for name in ('drums', 'bass', 'other')]
+                sample_rate, mixed_audio = mix_stems([os.path.join(target_dir, stem) for stem in stems])
+
                 if mixed_audio is not None:
-                     # Clip and convert back to 16-bit PCM for compatibility
-                     mixed_audio = np.clip(mixed_audio, -1.0, 1.0)
-                     mixed_audio = (mixed_audio * 32767).astype(np.int16)
                      wavfile.write(mix_path, sample_rate, mixed_audio)
                 else:
                     return jsonify({'error': 'Could not create mix'}), 500
@@ -594,8 +839,33 @@ def download_mix(filename, mix_type):
         log_exception("Mix download failed", e)
         return jsonify({'error': str(e)}), 500
 
+def preload_separator():
+    """
+    Build the separator before serving so model load and warmup overlap startup,
+    not the first /analyze-chords request. Called only in the serving process;
+    merely importing this module loads nothing. Other WSGI servers can call it
+    from their worker startup hook (e.g. gunicorn's post_fork).
+    """
+    get_separator(app.config['UPLOAD_FOLDER'])
+
 # -----------------------------
 # Entrypoint
 # -----------------------------
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    if os.getenv("FLASK_DEBUG") == "1":
+        # Werkzeug dev server with reloader/debugger; only the reloaded child serves
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            preload_separator()
+        app.run(debug=True, port=5000)
+    else:
+        # One process with a pool of request threads: a long /analyze-chords run
+        # occupies one thread while uploads and /api/* keep being served, and the
+        # demucs model, its CPU pools and device slots exist once
+        from waitress import serve
+        preload_separator()
+        serve(
+            app,
+            host=os.getenv("HOST", "0.0.0.0"),
+            port=int(os.getenv("PORT", "5000")),
+            threads=int(os.getenv("WEB_THREADS", "8")),
+        )
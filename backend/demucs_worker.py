@@ -0,0 +1,60 @@
+"""
+Long-running demucs worker for StemSeparator(persistent_worker=True).
+
+Loads the model once and reports {"ready": true, "quantized": ...} on stdout,
+then reads one JSON job per line from stdin:
+    {"id": ..., "audio_path": ..., "stems": [...] or null}
+and answers each with one JSON line on stdout:
+    {"id": ..., "stems": {name: path}} or {"id": ..., "error": "..."}
+The worker exits when stdin is closed.
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+
+from stem_separator import StemSeparator
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), stream=sys.stderr)
+logger = logging.getLogger("chord-app")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", required=True)
+    parser.add_argument("-n", "--model", default="htdemucs")
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("--quality", default="fast")
+    parser.add_argument("--shifts", type=int, default=None)
+    parser.add_argument("--overlap", type=float, default=None)
+    parser.add_argument("--format", default="wav")
+    args = parser.parse_args()
+
+    # stdout carries the protocol. fd 1 itself is pointed at stderr so nothing else,
+    # including native code writing to fd 1, can interleave with the replies
+    replies = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    separator = StemSeparator(args.out, model_name=args.model, jobs=args.jobs,
+                              quality_mode=args.quality, shifts=args.shifts,
+                              overlap=args.overlap, stem_format=args.format)
+    # Handshake: the parent keys its stem cache on these settings
+    replies.write(json.dumps({"ready": True, "quantized": separator.quantized}) + "\n")
+    replies.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            # The parent process owns the stem cache; always separate here
+            stems = separator.separate(job["audio_path"], job.get("stems"), use_cache=False)
+            reply = {"id": job["id"], "stems": stems}
+        except Exception as e:
+            reply = {"id": job["id"], "error": str(e)}
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,768 @@
+import io
 import os
+import sys
+import json
+import time
+import uuid
+import queue
+import shutil
+import hashlib
 import subprocess
 import logging
-import shlex
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 
 logger = logging.getLogger("chord-app")
 
+# Demucs is used in-process when it (and torch) can be imported here;
+# otherwise we fall back to running `python -m demucs.separate`. The imports happen
+# on first in-process use, so subprocess and worker modes never load torch here.
+torch = torchaudio = sf = get_model = apply_model = None
+
+def _import_backend():
+    """Import torch/demucs into this module; False if they aren't installed."""
+    global torch, torchaudio, sf, get_model, apply_model
+    if torch is None:
+        try:
+            import torch as _torch
+            import torchaudio as _torchaudio
+            import soundfile as _sf
+            from demucs.pretrained import get_model as _get_model
+            from demucs.apply import apply_model as _apply_model
+        except ImportError:
+            return False
+        torchaudio, sf, get_model, apply_model = _torchaudio, _sf, _get_model, _apply_model
+        torch = _torch
+    return True
+
+STEM_NAMES = ('vocals', 'drums', 'bass', 'other')
+
+# (shifts, overlap) per quality mode. Cost grows with (1 + shifts) and 1 / (1 - overlap);
+# each random shift buys only ~0.2 dB SDR, which chord/melody analysis doesn't need.
+QUALITY_MODES = {
+    "fast": (0, 0.10),
+    "balanced": (0, 0.25),
+    "quality": (5, 0.25),
+}
+
+# One concurrent run per GPU_BYTES_PER_RUN of device memory. Segment length is left
+# alone: in eval mode HTDemucs pads shorter segments back to its 7.8s training length,
+# so a smaller segment only adds forward passes without lowering peak memory
+GPU_BYTES_PER_RUN = 4 * 1024**3
+
+# Tracks only share a batch if the longest is at most this many times the shortest,
+# since every track in a batch is zero-padded to the longest one
+MAX_BATCH_PAD_RATIO = 1.25
+
+# Tracks longer than LONG_INPUT_SECONDS are separated in pieces of that length, so peak
+# memory follows the piece length rather than the track; each piece is read with
+# SEGMENT_CONTEXT_SECONDS of extra audio on both sides to avoid seams at the cuts
+LONG_INPUT_SECONDS = 180
+SEGMENT_CONTEXT_SECONDS = 2
+
+# Stem file formats and the demucs.separate flag selecting each. FLAC stems are
+# 16-bit lossless at roughly half the size of WAV
+STEM_FORMATS = {
+    "wav": (),
+    "flac": ("--flac",),
+}
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "demucs_worker.py")
+# A worker that takes longer than this to start or to answer a job is killed
+WORKER_TIMEOUT_SECONDS = 600
+
+# Only the tail of demucs' stderr (mostly progress bars) is kept for error messages
+STDERR_TAIL_BYTES = 64 * 1024
+
+# LIMIT_CPU=1 restricts demucs to a single core (constrained deployments)
+LIMIT_CPU = os.getenv("LIMIT_CPU") == "1"
+
+def available_cores():
+    """Cores this process may run on (its affinity mask, e.g. under taskset or a cpuset)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # No affinity API outside Linux
+        return os.cpu_count() or 1
+
+def default_jobs():
+    return 1 if LIMIT_CPU else available_cores()
+
+_threads_configured = False
+
+def _configure_torch_threads(jobs):
+    """
+    Size torch's CPU thread pools once so chunk jobs and MKL don't oversubscribe:
+    each of the `jobs` chunk threads gets an equal share of the cores for intra-op work
+    (one thread each with the default of one job per core).
+    """
+    global _threads_configured
+    if _threads_configured:
+        return
+    _threads_configured = True
+    if LIMIT_CPU:
+        torch.set_num_threads(1)
+        return
+    torch.set_num_threads(max(1, available_cores() // max(1, jobs)))
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        # Only allowed before any inter-op work has run
+        pass
+
+def _compile_model(model):
+    """torch.compile the network(s) apply_model actually calls."""
+    # A BagOfModels is never called itself; apply_model runs each sub-model
+    if hasattr(model, "models"):
+        model.models = torch.nn.ModuleList(
+            [torch.compile(m, mode="reduce-overhead", fullgraph=False) for m in model.models])
+        return model
+    return torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+# Loaded models keyed by (model name, device, quantized, compiled), shared by every StemSeparator
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+def _get_cached_model(name, device, quantize=False, compile=False):
+    """
+    Load `name` onto `device` at most once per process. quantize (CPU only)
+    applies dynamic int8 quantization to the model's Linear layers; compile
+    wraps it with torch.compile.
+    """
+    key = (name, device, quantize, compile)
+    with _MODEL_CACHE_LOCK:
+        model = _MODEL_CACHE.get(key)
+        if model is None:
+            model = get_model(name)
+            model.eval()
+            model.to(device)
+            if quantize:
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            if compile:
+                model = _compile_model(model)
+            _MODEL_CACHE[key] = model
+            logger.info(f"Loaded demucs model '{name}' on {device}"
+                        + (" (int8)" if quantize else "") + (" (compiled)" if compile else ""))
+        return model
+
 class StemSeparator:
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, model_name="htdemucs", in_process=True,
+                 max_batch=1, batch_window=0.05, jobs=None,
+                 quality_mode="fast", shifts=None, overlap=None, compile_model=False,
+                 stem_format="wav", persistent_worker=False, worker_timeout=WORKER_TIMEOUT_SECONDS):
+        """
+        output_dir: where stems are written, as output_dir/{model}/{upload name}/;
+            separated stems are also cached under output_dir/.cache by audio
+            content hash. Entries are hard links to the per-upload stems, which
+            live as long as the uploads do, so the cache adds no disk use of its
+            own and isn't size-bounded.
+        model_name: the demucs pretrained model.
+        in_process: run demucs in this process when torch/demucs import; otherwise
+            use the demucs CLI (or the persistent worker).
+        max_batch, batch_window: max_batch > 1 enables micro-batching; concurrent
+            separate() calls that arrive within batch_window seconds of each other
+            share one apply_model call.
+        jobs: parallel demucs chunk workers on CPU (default: the cores available
+            to this process, or 1 with LIMIT_CPU). Ignored on GPU.
+        quality_mode: picks demucs' shifts/overlap from QUALITY_MODES (the demucs
+            CLI default is "balanced"); shifts and overlap override it.
+        compile_model: run the model through torch.compile (fused kernels, no
+            per-layer Python dispatch).
+        stem_format: file format the stems are written in (see STEM_FORMATS).
+        persistent_worker, worker_timeout: when not in_process, run demucs in one
+            long-lived demucs_worker.py process instead of a subprocess per call,
+            so interpreter start, torch import and model load happen once. A
+            worker that doesn't answer within worker_timeout seconds is killed
+            and restarted.
+
+        In-process models are warmed up on a background thread at construction;
+        separate() waits for that to finish before its first run.
+        """
         self.output_dir = output_dir
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        self.model_name = model_name
+        self.jobs = jobs or default_jobs()
+        mode_shifts, mode_overlap = QUALITY_MODES[quality_mode]
+        self.quality_mode = quality_mode
+        self.shifts = mode_shifts if shifts is None else shifts
+        self.overlap = mode_overlap if overlap is None else overlap
+        self.stem_ext = "." + stem_format
+        self.cache_root = os.path.join(output_dir, ".cache")
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.in_process = in_process and _import_backend()
+        self.model = None
+        self.quantized = False
+        self._pool = None
+        if self.in_process:
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            # int8 Linear layers cost ~0.3-0.6 dB SDR, so only in "fast" mode on CPU
+            self.quantized = self.device == "cpu" and quality_mode == "fast"
+            if self.device == "cpu":
+                _configure_torch_threads(self.jobs)
+            self.model = _get_cached_model(model_name, self.device, self.quantized, compile_model)
+            # Reused across calls; apply_model would otherwise build a pool per call
+            self._pool = ThreadPoolExecutor(self.jobs) if self.device == "cpu" and self.jobs > 1 else None
+
+        self._device_slots = None
+        if self.in_process and self.device == "cuda":
+            total_vram = torch.cuda.get_device_properties(0).total_memory
+            # Admit as many concurrent separations as the card can hold
+            self._device_slots = threading.BoundedSemaphore(max(1, total_vram // GPU_BYTES_PER_RUN))
+
+        # The first forward pays for cuDNN autotuning, kernel compilation (compile_model)
+        # and MKL plan setup; run it here rather than on the first request
+        self._warm = threading.Event()
+        if self.in_process:
+            threading.Thread(target=self._warmup, name="demucs-warmup", daemon=True).start()
+        else:
+            self._warm.set()
+
+        # Everything but the per-call stem selection and input path is fixed
+        self._base_cmd = (
+            "python", "-m", "demucs.separate",
+            "-n", model_name,
+            "--out", output_dir,
+            "-j", str(self.jobs),
+            "--shifts", str(self.shifts),
+            "--overlap", str(self.overlap),
+            *STEM_FORMATS[stem_format],
+        )
+
+        # demucs.separate parallelizes across -j chunk workers; one BLAS/OpenMP thread
+        # each avoids oversubscribing the cores, and fewer malloc arenas bound RSS
+        self._subprocess_env = os.environ.copy()
+        if self.jobs > 1 or LIMIT_CPU:
+            self._subprocess_env.update({
+                "OMP_NUM_THREADS": "1",
+                "MKL_NUM_THREADS": "1",
+                "KMP_AFFINITY": "granularity=fine,compact",
+            })
+        self._subprocess_env["MALLOC_ARENA_MAX"] = "2"
 
-    def separate(self, audio_path):
+        # Persistent worker: started here, restarted by _separate_worker if it dies
+        self._worker = None
+        self._worker_replies = None
+        self._worker_lock = threading.Lock()
+        self._worker_timeout = worker_timeout
+        self._worker_cmd = None
+        if not self.in_process and persistent_worker:
+            self._worker_cmd = (
+                sys.executable, WORKER_SCRIPT,
+                "--out", output_dir,
+                "-n", model_name,
+                "-j", str(self.jobs),
+                "--quality", quality_mode,
+                "--shifts", str(self.shifts),
+                "--overlap", str(self.overlap),
+                "--format", stem_format,
+            )
+            self._start_worker()
+
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._jobs = queue.Queue()
+        if self.in_process and max_batch > 1:
+            threading.Thread(target=self._batch_worker, name="demucs-batcher", daemon=True).start()
+
+    def separate(self, audio_path, stems_wanted=None, digest=None, use_cache=True):
         """
         Runs demucs on the audio file.
         Returns a dictionary of stem paths: {'vocals': path, 'drums': path, ...}
+
+        stems_wanted limits which stems are written and returned (default: all).
+        A single stem gives demucs' two-stems output: {stem: ..., 'no_<stem>': ...}.
+        digest is the file's 16-byte BLAKE2b hex digest if the caller already has
+        it; otherwise the file is hashed here for the stem cache.
+        use_cache=False always runs demucs and leaves the stem cache alone.
         """
         logger.info(f"Starting stem separation for: {audio_path}")
-        
-        # We use the 'htdemucs' model (Hybrid Transformer) which is fast and good.
-        # -n htdemucs
-        # --out output_dir
-        cmd = [
-            "python", "-m", "demucs.separate",
-            "-n", "htdemucs",
-            "--out", self.output_dir,
-            audio_path
-        ]
-        
+        wanted = set(stems_wanted) if stems_wanted else None
+        cache_dir = None
+        if use_cache:
+            cache_dir, stems = self._lookup_cache(audio_path, wanted, digest)
+            if stems is not None:
+                return stems
+
+        if self.in_process:
+            self._warm.wait()
+            stems = self._separate_in_process(audio_path, wanted)
+        elif self._worker_cmd:
+            stems = self._separate_worker(audio_path, wanted)
+        else:
+            stems = self._separate_subprocess(audio_path, wanted)
+
+        if use_cache:
+            self._remember(cache_dir, audio_path, stems)
+        return stems
+
+    # -----------------------------
+    # Content-hash stem cache
+    # -----------------------------
+    def _lookup_cache(self, audio_path, wanted, digest=None):
+        """Returns (cache_dir, stems); stems is None on a miss."""
+        cache_dir = os.path.join(self.cache_root, self._content_key(audio_path, digest))
+        # Only complete 4-stem sets are cached; two-stem output always runs demucs
+        if wanted is None or len(wanted) > 1:
+            stems = self._from_cache(cache_dir, audio_path)
+            if stems is not None:
+                logger.info(f"Stem cache hit: {cache_dir}")
+                return cache_dir, {name: path for name, path in stems.items()
+                                   if wanted is None or name in wanted}
+        return cache_dir, None
+
+    def _remember(self, cache_dir, audio_path, stems):
+        try:
+            self._store_in_cache(cache_dir, stems)
+        except OSError as e:
+            logger.warning(f"Could not cache stems for {audio_path}: {e}")
+
+    @property
+    def settings_key(self):
+        """The settings that change the stems: model, int8, shifts/overlap and file format."""
+        quant = "-q8" if self.quantized else ""
+        return f"{self.model_name}{quant}-s{self.shifts}-o{self.overlap}-{self.stem_ext[1:]}"
+
+    def _content_key(self, audio_path, digest=None):
+        if digest is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(audio_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+        # Stems depend on the separator settings as well as the audio
+        return f"{self.settings_key}-{digest}"
+
+    @staticmethod
+    def _link_or_copy(src, dst):
+        # Hard links share the data blocks; copy when crossing filesystems
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            os.remove(dst)
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    def _from_cache(self, cache_dir, audio_path):
+        # One directory read instead of a stat per stem
+        ext = self.stem_ext
+        try:
+            with os.scandir(cache_dir) as it:
+                cached = {entry.name[:-len(ext)]: entry.path for entry in it
+                          if entry.name.endswith(ext) and entry.name[:-len(ext)] in STEM_NAMES}
+        except FileNotFoundError:
+            return None
+        if len(cached) < len(STEM_NAMES):
+            return None
+
+        # Expose the stems at the usual per-upload location as well
+        target_dir = self._target_dir(audio_path)
+        os.makedirs(target_dir, exist_ok=True)
+        prefix = target_dir + os.sep
+        stems = {}
+        for stem, path in cached.items():
+            stem_path = prefix + stem + ext
+            self._link_or_copy(path, stem_path)
+            stems[stem] = stem_path
+        return stems
+
+    def _store_in_cache(self, cache_dir, stems):
+        if not all(stem in stems for stem in STEM_NAMES) or os.path.exists(cache_dir):
+            return
+        # Fill a temp dir and rename it into place so readers never see a partial entry
+        tmp_dir = f"{cache_dir}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_dir)
+        prefix = tmp_dir + os.sep
+        try:
+            for stem in STEM_NAMES:
+                self._link_or_copy(stems[stem], prefix + stem + self.stem_ext)
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _target_dir(self, audio_path):
+        # Same layout as the demucs CLI: output_dir/{model}/{filename_no_ext}/{stem}.{ext}
+        name_no_ext = os.path.splitext(os.path.basename(audio_path))[0]
+        return os.path.join(self.output_dir, self.model_name, name_no_ext)
+
+    def _autocast(self):
+        # fp16 on CUDA so conv/attention matmuls run on tensor cores; weights stay fp32
+        if self.device == "cuda":
+            return torch.autocast("cuda", dtype=torch.float16)
+        return nullcontext()
+
+    def _warmup(self):
+        # One second is enough: split=True pads every chunk to the full segment length
+        silence = torch.zeros(1, 2, self.model.samplerate, device=self.device)
+        try:
+            with torch.inference_mode(), self._autocast():
+                apply_model(self.model, silence, device=self.device, shifts=0, split=True,
+                            overlap=self.overlap, pool=self._pool)
+            logger.info("Demucs warmup complete")
+        except Exception as e:
+            logger.warning(f"Demucs warmup failed: {e}")
+        finally:
+            self._warm.set()
+
+    def _separate_in_process(self, audio_path, wanted):
+        info = self._long_input_info(audio_path)
+        if info is not None:
+            return self._separate_long(audio_path, wanted, *info)
+        if self.max_batch > 1:
+            future = Future()
+            self._jobs.put((audio_path, wanted, future))
+            return future.result()
+        return self._run_batch([audio_path], [wanted])[0]
+
+    def _batch_worker(self):
+        while True:
+            # Block for the first job, then collect more until the window closes
+            jobs = [self._jobs.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(jobs) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self._jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Decode each job on its own so one bad upload only fails its own caller
+            decoded = []
+            for path, wanted, future in jobs:
+                try:
+                    decoded.append((path, wanted, future, self._load(path)))
+                except Exception as e:
+                    logger.error(f"Could not decode {path}: {e}")
+                    future.set_exception(e)
+
+            for group in self._length_groups([loaded[0].shape[-1] for _, _, _, loaded in decoded]):
+                group_jobs = [decoded[i] for i in group]
+                try:
+                    results = self._run_batch([path for path, _, _, _ in group_jobs],
+                                              [wanted for _, wanted, _, _ in group_jobs],
+                                              [loaded for _, _, _, loaded in group_jobs])
+                except Exception as e:
+                    for _, _, future, _ in group_jobs:
+                        future.set_exception(e)
+                else:
+                    for (_, _, future, _), stems in zip(group_jobs, results):
+                        future.set_result(stems)
+
+    @staticmethod
+    def _length_groups(lengths):
+        """Indices into lengths, grouped so no group pads past MAX_BATCH_PAD_RATIO."""
+        groups = []
+        for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+            if groups and lengths[i] <= lengths[groups[-1][0]] * MAX_BATCH_PAD_RATIO:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        return groups
+
+    @staticmethod
+    def _audio_info(audio_path):
+        """(frames, sample rate) from the file header, or None if it can't be read."""
+        try:
+            info = sf.info(audio_path)
+            return info.frames, info.samplerate
+        except RuntimeError:
+            pass
+        try:
+            info = torchaudio.info(audio_path)
+            return info.num_frames, info.sample_rate
+        except (RuntimeError, AttributeError):
+            return None
+
+    def _long_input_info(self, audio_path):
+        """(frames, sample rate) if the track is long enough to separate in pieces, else None."""
+        info = self._audio_info(audio_path)
+        if info is not None and info[0] > LONG_INPUT_SECONDS * info[1]:
+            return info
+        return None
+
+    def _load(self, audio_path, frame_offset=0, num_frames=-1):
+        """Decode to the model's rate/channels; returns (normalized wav, ref)."""
+        # Decoded in-process (no ffmpeg pipe) with libsndfile; torchaudio only for formats
+        # it can't read (torchaudio >= 2.9 needs torchcodec for load/save)
+        try:
+            stop = None if num_frames < 0 else frame_offset + num_frames
+            data, sr = sf.read(audio_path, start=frame_offset, stop=stop, dtype="float32", always_2d=True)
+            wav = torch.from_numpy(data.T.copy())
+        except RuntimeError:
+            wav, sr = torchaudio.load(audio_path, frame_offset=frame_offset, num_frames=num_frames)
+        if sr != self.model.samplerate:
+            wav = torchaudio.functional.resample(wav, sr, self.model.samplerate)
+        # Model expects stereo
+        if wav.shape[0] == 1:
+            wav = wav.repeat(2, 1)
+        elif wav.shape[0] > 2:
+            wav = wav[:2]
+
+        # Normalize like demucs.separate does; the outputs are denormalized with ref
+        ref = wav.mean(0)
+        return (wav - ref.mean()) / ref.std(), ref
+
+    def _stem_outputs(self, sources, wanted):
+        """(name, tensor) pairs to write for one track's sources."""
+        names = list(self.model.sources)
+        if wanted and len(wanted) == 1:
+            # Two-stems output, like `demucs --two-stems`
+            stem = next(iter(wanted))
+            idx = names.index(stem)
+            return [(stem, sources[idx]), (f"no_{stem}", sources.sum(0) - sources[idx])]
+        return [(name, source) for name, source in zip(names, sources)
+                if not wanted or name in wanted]
+
+    def _save_stems(self, audio_path, sources, wanted=None):
+        target_dir = self._target_dir(audio_path)
+        os.makedirs(target_dir, exist_ok=True)
+
+        stems = {}
+        for name, source in self._stem_outputs(sources, wanted):
+            # soundfile picks the container from the extension
+            stem_path = os.path.join(target_dir, name + self.stem_ext)
+            source = source.float().cpu()
+            # Scale down instead of clipping, like demucs' save_audio(clip="rescale")
+            source = source / max(1.01 * source.abs().max().item(), 1)
+            sf.write(stem_path, source.T.numpy(), self.model.samplerate, subtype="PCM_16")
+            stems[name] = stem_path
+        return stems
+
+    def _separate_long(self, audio_path, wanted, total_frames, sr):
+        """
+        Separate a long track LONG_INPUT_SECONDS at a time, appending each piece
+        to the stem files so only one piece's activations are alive at once.
+        """
+        target_dir = self._target_dir(audio_path)
+        os.makedirs(target_dir, exist_ok=True)
+        step = LONG_INPUT_SECONDS * sr
+        context = SEGMENT_CONTEXT_SECONDS * sr
+        ratio = self.model.samplerate / sr
+        writers = {}
+        try:
+            for start in range(0, total_frames, step):
+                stop = min(start + step, total_frames)
+                read_start = max(0, start - context)
+                read_stop = min(total_frames, stop + context)
+                wav, ref = self._load(audio_path, read_start, read_stop - read_start)
+
+                with self._device_slots or nullcontext(), torch.inference_mode(), self._autocast():
+                    sources = apply_model(self.model, wav[None], device=self.device,
+                                          shifts=self.shifts, split=True, overlap=self.overlap,
+                                          pool=self._pool)
+                # Drop the context again, in model-rate samples
+                lo = round((start - read_start) * ratio)
+                hi = lo + round(stop * ratio) - round(start * ratio)
+                track = sources[0, :, :, lo:hi].float() * ref.std() + ref.mean()
+
+                for name, source in self._stem_outputs(track, wanted):
+                    if name not in writers:
+                        writers[name] = sf.SoundFile(os.path.join(target_dir, name + self.stem_ext), "w",
+                                                     samplerate=self.model.samplerate,
+                                                     channels=source.shape[0], subtype="PCM_16")
+                    # Pieces can't be rescaled as a whole like save_audio does; clamp instead
+                    writers[name].write(source.clamp(-1, 1).T.cpu().numpy())
+
+                del wav, sources, track
+                if self.device == "cuda":
+                    torch.cuda.empty_cache()
+        except Exception as e:
+            logger.error(f"Stem separation failed: {e}")
+            raise e
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        logger.info(f"Demucs completed successfully ({total_frames / sr:.0f}s track in pieces)")
+        return {name: writer.name for name, writer in writers.items()}
+
+    def separate_batch(self, audio_paths, stems_wanted=None):
+        """
+        Separate several files with batched apply_model calls (in-process only).
+        Tracks of similar length share a call; they are zero-padded to the
+        longest one and trimmed again afterwards.
+        Returns one stems dict per path, in order.
+        """
+        wanted = set(stems_wanted) if stems_wanted else None
+        self._warm.wait()
+        results = [None] * len(audio_paths)
+        short = []
+        for i, path in enumerate(audio_paths):
+            info = self._long_input_info(path)
+            if info is not None:
+                # Never decoded whole; separated piecewise like in separate()
+                results[i] = self._separate_long(path, wanted, *info)
+            else:
+                short.append(i)
+
+        loaded = [self._load(audio_paths[i]) for i in short]
+        for group in self._length_groups([wav.shape[-1] for wav, _ in loaded]):
+            stems = self._run_batch([audio_paths[short[j]] for j in group], [wanted] * len(group),
+                                    [loaded[j] for j in group])
+            for j, track_stems in zip(group, stems):
+                results[short[j]] = track_stems
+        return results
+
+    def _run_batch(self, audio_paths, wanted_per_path, loaded=None):
+        try:
+            if loaded is None:
+                loaded = [self._load(path) for path in audio_paths]
+            lengths = [wav.shape[-1] for wav, _ in loaded]
+            max_len = max(lengths)
+            batch = torch.stack([torch.nn.functional.pad(wav, (0, max_len - wav.shape[-1]))
+                                 for wav, _ in loaded])
+
+            with self._device_slots or nullcontext(), torch.inference_mode(), self._autocast():
+                sources = apply_model(self.model, batch, device=self.device,
+                                      shifts=self.shifts, split=True, overlap=self.overlap,
+                                      pool=self._pool)
+
+            results = []
+            for i, (path, (_, ref), length) in enumerate(zip(audio_paths, loaded, lengths)):
+                track = sources[i, :, :, :length].float() * ref.std() + ref.mean()
+                results.append(self._save_stems(path, track, wanted_per_path[i]))
+
+            logger.info(f"Demucs completed successfully ({len(audio_paths)} track(s))")
+            return results
+
+        except Exception as e:
+            logger.error(f"Stem separation failed: {e}")
+            raise e
+
+    def _subprocess_cmd(self, audio_path, wanted):
+        """argv for `demucs.separate` plus the stem names it will produce."""
+        if wanted and len(wanted) == 1:
+            stem = next(iter(wanted))
+            return [*self._base_cmd, f"--two-stems={stem}", audio_path], [stem, f"no_{stem}"]
+        stem_names = [name for name in STEM_NAMES if not wanted or name in wanted]
+        return [*self._base_cmd, audio_path], stem_names
+
+    def _collect_subprocess_stems(self, audio_path, stem_names):
+        # Demucs structure: output_dir/htdemucs/{filename_no_ext}/{stem}.{ext}
+        filename = os.path.basename(audio_path)
+        name_no_ext = os.path.splitext(filename)[0]
+
+        # The actual folder name demucs creates might depend on the input filename
+        # Demucs cleans the filename (spaces to _, etc).
+        # Ideally we should verify the folder exists.
+
+        # Let's find the folder
+        model_dir = os.path.join(self.output_dir, self.model_name)
+        # We look for the most recently modified folder if specific name is tricky,
+        # but usually it's the filename.
+        # Let's try likely candidates
+        target_dir = os.path.join(model_dir, name_no_ext)
+        # No guessing at other folders: with concurrent uploads the newest one
+        # may belong to someone else. A missing folder means no stems.
+
+        # One directory read instead of a stat per stem
+        ext = self.stem_ext
+        try:
+            with os.scandir(target_dir) as it:
+                present = {entry.name[:-len(ext)]: entry.path for entry in it if entry.name.endswith(ext)}
+        except FileNotFoundError:
+            present = {}
+        return {stem: present[stem] for stem in stem_names if stem in present}
+
+    def _separate_subprocess(self, audio_path, wanted=None):
+        cmd, stem_names = self._subprocess_cmd(audio_path, wanted)
+
         try:
             # Run Demucs
             # This might take time (30s - 2min on CPU)
-            process = subprocess.run(
-                cmd, 
-                check=True, 
-                capture_output=True, 
-                text=True
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                bufsize=io.DEFAULT_BUFFER_SIZE,
+                env=self._subprocess_env
             )
+            # Drain stderr so the pipe never fills, keeping only a bounded tail as raw bytes
+            tail = deque()
+            tail_size = 0
+            with process.stderr:
+                for chunk in iter(lambda: process.stderr.read1(io.DEFAULT_BUFFER_SIZE), b""):
+                    tail.append(chunk)
+                    tail_size += len(chunk)
+                    while tail_size - len(tail[0]) >= STDERR_TAIL_BYTES:
+                        tail_size -= len(tail.popleft())
+            if process.wait():
+                # Decoded only on the error path
+                err = b"".join(tail)[-STDERR_TAIL_BYTES:].decode("utf-8", "replace")
+                logger.error(f"Demucs failed: {err}")
+                raise Exception(f"Demucs processing failed: {err}")
             logger.info("Demucs completed successfully")
-            
-            # Demucs structure: output_dir/htdemucs/{filename_no_ext}/{stem}.wav
-            filename = os.path.basename(audio_path)
-            name_no_ext = os.path.splitext(filename)[0]
-            
-            # The actual folder name demucs creates might depend on the input filename
-            # Demucs cleans the filename (spaces to _, etc). 
-            # Ideally we should verify the folder exists.
-            
-            # Let's find the folder
-            model_dir = os.path.join(self.output_dir, "htdemucs")
-            # We look for the most recently modified folder if specific name is tricky,
-            # but usually it's the filename.
-            # Let's try likely candidates
-            target_dir = os.path.join(model_dir, name_no_ext)
-            
-            if not os.path.exists(target_dir):
-                # Fallback: check subdirs in model_dir
-                subdirs = [os.path.join(model_dir, d) for d in os.listdir(model_dir) if os.path.isdir(os.path.join(model_dir, d))]
-                # Find the one that matches our file best or just the latest
-                # For safety, let's assume it matches name_no_ext mostly.
-                # If we passed a safe filename like uuid_name.mp3, it should be uuid_name
-                pass
-
-            stems = {}
-            for stem in ['vocals', 'drums', 'bass', 'other']:
-                stem_path = os.path.join(target_dir, f"{stem}.wav")
-                if os.path.exists(stem_path):
-                    stems[stem] = stem_path
-            
-            return stems
-
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Demucs failed: {e.stderr}")
-            raise Exception(f"Demucs processing failed: {e.stderr}")
+
+            return self._collect_subprocess_stems(audio_path, stem_names)
+
         except Exception as e:
             logger.error(f"Stem separation failed: {e}")
             raise e
+
+    def _start_worker(self):
+        # stderr is inherited so the worker's logs land next to ours
+        self._worker = subprocess.Popen(
+            self._worker_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=1,
+            text=True
+        )
+        # Replies are read on a thread so waiting for one can time out
+        self._worker_replies = queue.Queue()
+        threading.Thread(target=self._read_worker, args=(self._worker, self._worker_replies),
+                         name="demucs-worker-reader", daemon=True).start()
+
+        # The worker reports its effective settings once the model is loaded; the
+        # stem cache key must match what it actually runs (e.g. int8 on CPU)
+        ready = self._worker_reply()
+        self.quantized = bool(ready.get("quantized"))
+
+    @staticmethod
+    def _read_worker(proc, replies):
+        for line in proc.stdout:
+            replies.put(line)
+        replies.put(None)  # EOF: the worker exited
+
+    def _worker_reply(self):
+        """Next reply from the worker; kills it and raises if it exits or times out."""
+        try:
+            line = self._worker_replies.get(timeout=self._worker_timeout)
+        except queue.Empty:
+            line = None
+            logger.error(f"Demucs worker gave no reply within {self._worker_timeout}s")
+        if line is None:
+            self._worker.kill()
+            self._worker.wait()
+            raise Exception("Demucs processing failed: worker exited or timed out")
+        return json.loads(line)
+
+    def _separate_worker(self, audio_path, wanted=None):
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "audio_path": audio_path, "stems": sorted(wanted) if wanted else None}
+
+        # One job in flight at a time: request and reply lines must pair up
+        with self._worker_lock:
+            if self._worker is None or self._worker.poll() is not None:
+                logger.warning("Demucs worker not running, starting a new one")
+                self._start_worker()
+            try:
+                self._worker.stdin.write(json.dumps(job) + "\n")
+                self._worker.stdin.flush()
+            except OSError as e:
+                # The reader thread sees EOF, so _worker_reply raises below
+                logger.error(f"Demucs worker pipe failed: {e}")
+            reply = self._worker_reply()
+
+        if reply.get("id") != job_id:
+            raise Exception(f"Demucs processing failed: unexpected reply {reply.get('id')}")
+        if "error" in reply:
+            # Already logged and prefixed by the worker
+            raise Exception(reply["error"])
+        logger.info("Demucs completed successfully")
+        return reply["stems"]